@@ -123,6 +123,8 @@ class AgentFormerDataset(Dataset):
             'pre_motion_mask': pre_motion_mask,
             'pre_data': pre_data,
             'fut_data': fut_data,
+            'pre_row_of': pre_row_of,
+            'fut_row_of': fut_row_of,
             'heading': heading,
             'valid_id': valid_id,
             'traj_scale': self.traj_scale,
@@ -78,6 +78,14 @@ class preprocess(object):
             DataList.append(data)
         return DataList
 
+    def RowLookup(self, DataTuple):
+        # track_id -> row index of each frame, so agents can be gathered without a mask scan
+        RowList = []
+        for data in DataTuple:
+            track_ids = [] if isinstance(data, list) else data[:, 1].tolist()
+            RowList.append({track_id: row for row, track_id in enumerate(track_ids)})
+        return RowList
+
     def get_valid_id(self, pre_data, fut_data):
         cur_id = self.GetID(pre_data[0])
         valid_id = []
@@ -113,7 +121,7 @@ class preprocess(object):
         self.geom_scene_map = GeometricMap(self.scene_map, homography, self.map_origin)
         self.scene_vis_map = GeometricMap(self.scene_vis_map, homography, self.map_origin)
 
-    def PreMotion(self, DataTuple, valid_id):
+    def PreMotion(self, DataTuple, valid_id, RowTuple):
         motion = []
         mask = []
         for identity in valid_id:
@@ -121,8 +129,9 @@ class preprocess(object):
             box_3d = torch.zeros([self.past_frames, 2])
             for j in range(self.past_frames):
                 past_data = DataTuple[j]              # past_data
-                if len(past_data) > 0 and identity in past_data[:, 1]:
-                    found_data = past_data[past_data[:, 1] == identity].squeeze()[[self.xind, self.zind]] / self.past_traj_scale
+                row = RowTuple[j].get(identity)
+                if row is not None:
+                    found_data = past_data[row, [self.xind, self.zind]] / self.past_traj_scale
                     box_3d[self.past_frames-1 - j, :] = torch.from_numpy(found_data).float()
                     mask_i[self.past_frames-1 - j] = 1.0
                 elif j > 0:
@@ -133,7 +142,7 @@ class preprocess(object):
             mask.append(mask_i)
         return motion, mask
 
-    def FutureMotion(self, DataTuple, valid_id):
+    def FutureMotion(self, DataTuple, valid_id, RowTuple):
         motion = []
         mask = []
         for identity in valid_id:
@@ -141,8 +150,9 @@ class preprocess(object):
             pos_3d = torch.zeros([self.future_frames, 2])
             for j in range(self.future_frames):
                 fut_data = DataTuple[j]              # cur_data
-                if len(fut_data) > 0 and identity in fut_data[:, 1]:
-                    found_data = fut_data[fut_data[:, 1] == identity].squeeze()[[self.xind, self.zind]] / self.traj_scale
+                row = RowTuple[j].get(identity)
+                if row is not None:
+                    found_data = fut_data[row, [self.xind, self.zind]] / self.traj_scale
                     pos_3d[j, :] = torch.from_numpy(found_data).float()
                     mask_i[j] = 1.0
                 elif j > 0:
@@ -171,8 +181,10 @@ class preprocess(object):
             pred_mask = None
             heading = None
 
-        pre_motion_3D, pre_motion_mask = self.PreMotion(pre_data, valid_id)
-        fut_motion_3D, fut_motion_mask = self.FutureMotion(fut_data, valid_id)
+        pre_row_of = self.RowLookup(pre_data)
+        fut_row_of = self.RowLookup(fut_data)
+        pre_motion_3D, pre_motion_mask = self.PreMotion(pre_data, valid_id, pre_row_of)
+        fut_motion_3D, fut_motion_mask = self.FutureMotion(fut_data, valid_id, fut_row_of)
 
         data = {
             'pre_motion_3D': pre_motion_3D,
@@ -181,6 +193,8 @@ class preprocess(object):
             'pre_motion_mask': pre_motion_mask,
             'pre_data': pre_data,
             'fut_data': fut_data,
+            'pre_row_of': pre_row_of,
+            'fut_row_of': fut_row_of,
             'heading': heading,
             'valid_id': valid_id,
             'traj_scale': self.traj_scale,
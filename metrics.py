@@ -2,12 +2,60 @@ import numpy as np
 from scipy.spatial.distance import pdist, squareform, cdist
 from functools import partial
 
+try:
+    import numba
+except ImportError:  # numba is optional, the numpy implementations are used without it
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+# no fastmath and no implicit upcasts in the kernels, so they give the same values as the numpy path
+_njit = numba.njit(cache=True) if NUMBA_AVAILABLE else (lambda func: func)
+
+
+@_njit
+def _displacement_error_kernel(pred_arr, gt_arr):
+    num_peds, num_samples, num_frames, num_dims = pred_arr.shape
+    dist = np.empty((num_peds, num_samples, num_frames), dtype=pred_arr.dtype)
+    for ped_i in range(num_peds):
+        for sample_i in range(num_samples):
+            for t in range(num_frames):
+                diff = pred_arr[ped_i, sample_i, t, 0] - gt_arr[ped_i, t, 0]
+                sq = diff * diff
+                for d in range(1, num_dims):
+                    diff = pred_arr[ped_i, sample_i, t, d] - gt_arr[ped_i, t, d]
+                    sq += diff * diff
+                dist[ped_i, sample_i, t] = np.sqrt(sq)
+    return dist
+
+
+def _displacement_error(pred_arr, gt_arr):
+    """Input:
+        - pred_arr: (num_peds, samples, frames, 2)
+        - gt_arr: (num_peds, frames, 2)
+    Return:
+        L2 distance of each ped-sample-frame (num_peds, samples, frames)"""
+    if NUMBA_AVAILABLE:
+        dtype = np.result_type(pred_arr, gt_arr)
+        return _displacement_error_kernel(np.ascontiguousarray(pred_arr, dtype=dtype),
+                                          np.ascontiguousarray(gt_arr, dtype=dtype))
+    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
+    return np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+
+
+def warmup_kernels():
+    """Compile (or load from the numba cache) the jitted kernels for the float32 arrays used in evaluation,
+    so the first sequence a worker evaluates does not pay for it."""
+    if not NUMBA_AVAILABLE:
+        return
+    pred_arr = np.zeros((2, 1, 2, 2), dtype=np.float32)
+    _displacement_error_kernel(pred_arr, pred_arr[:, 0])
+    _collision_mats_kernel(pred_arr[:, 0], 0.2, np.float32(0.2))
+
 
 def compute_ADE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=False, **kwargs):
     pred_arr = np.array(pred_arr)
     gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+    dist = _displacement_error(pred_arr, gt_arr)  # num_peds x samples x frames
     ade_per_sample = dist.mean(axis=-1).mean(axis=0)  # samples
     ade = ade_per_sample.min(axis=0)  # (1, )
     return_vals = [ade]
@@ -21,8 +69,7 @@ def compute_ADE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=
 def compute_FDE_joint(pred_arr, gt_arr, return_sample_vals=False, return_argmin=False, **kwargs):
     pred_arr = np.array(pred_arr)
     gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+    dist = _displacement_error(pred_arr, gt_arr)  # num_peds x samples x frames
     fde_per_sample = dist[..., -1].mean(axis=0)  # samples
     fde = fde_per_sample.min(axis=0)  # (1, )
     return_vals = [fde]
@@ -39,8 +86,7 @@ def compute_ADE_marginal(pred_arr, gt_arr, return_sample_vals=False, return_ped_
     # assert pred_arr.shape[1] == 20, pred_arr.shape
     pred_arr = np.array(pred_arr)
     gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+    dist = _displacement_error(pred_arr, gt_arr)  # num_peds x samples x frames
     ades_per_sample = dist.mean(axis=-1)  # num_peds x samples
     made_per_ped = ades_per_sample.min(axis=-1)  # num_peds
     avg_made = made_per_ped.mean(axis=-1)  # (1,)
@@ -59,8 +105,7 @@ def compute_FDE_marginal(pred_arr, gt_arr, return_sample_vals=False, return_ped_
     """about 4 times faster due to numpy vectorization"""
     pred_arr = np.array(pred_arr)
     gt_arr = np.array(gt_arr)
-    diff = pred_arr - np.expand_dims(gt_arr, axis=1)  # num_peds x samples x frames x 2
-    dist = np.linalg.norm(diff, axis=-1)  # num_peds x samples x frames
+    dist = _displacement_error(pred_arr, gt_arr)  # num_peds x samples x frames
     fdes_per_sample = dist[..., -1]  # num_peds x samples
     mfde_per_ped = fdes_per_sample.min(axis=-1)  # num_peds
     avg_mfde = mfde_per_ped.mean(axis=-1)  # (1,)
@@ -126,10 +171,60 @@ def _get_diffs_gt(traj, gt_traj):
             axis=1)
 
 
+@_njit
+def _collision_mats_kernel(sample, thresh_0, thresh_t):
+    """Same result as the pdist / _lineseg_dist path of check_collision_per_sample_no_gt.
+    pdist works in float64 while _lineseg_dist keeps the dtype of sample, hence the two thresholds.
+    Input:
+        - sample: (ts, n_ped, 2)
+        - thresh_0: (float64) collision distance at the first timestep
+        - thresh_t: (sample.dtype) collision distance for the following timesteps
+    Return:
+        collision matrix of each timestep (ts, n_ped, n_ped)"""
+    ts, num_peds, _ = sample.shape
+    col_mats = np.zeros((ts, num_peds, num_peds), dtype=np.bool_)
+    for ped_i in range(num_peds):
+        for ped_j in range(ped_i + 1, num_peds):
+            dx0 = np.float64(sample[0, ped_i, 0]) - np.float64(sample[0, ped_j, 0])
+            dy0 = np.float64(sample[0, ped_i, 1]) - np.float64(sample[0, ped_j, 1])
+            collide = np.sqrt(dx0 * dx0 + dy0 * dy0) < thresh_0
+            col_mats[0, ped_i, ped_j] = collide
+            col_mats[0, ped_j, ped_i] = collide
+            ax = sample[0, ped_i, 0] - sample[0, ped_j, 0]
+            ay = sample[0, ped_i, 1] - sample[0, ped_j, 1]
+            for t in range(1, ts):
+                bx = sample[t, ped_i, 0] - sample[t, ped_j, 0]
+                by = sample[t, ped_i, 1] - sample[t, ped_j, 1]
+                if ax == bx and ay == by:  # edge case where the pair keeps the same offset
+                    dist = np.sqrt(ax * ax + ay * ay)
+                else:
+                    # distance of the origin to the segment a->b of the relative motion
+                    seg_len = np.sqrt((bx - ax) * (bx - ax) + (by - ay) * (by - ay))
+                    dx = (bx - ax) / seg_len
+                    dy = (by - ay) / seg_len
+                    s = ax * dx + ay * dy
+                    u = -bx * dx + -by * dy
+                    h = max(s, u, s - s)
+                    c = -ax * dy - -ay * dx
+                    dist = np.hypot(h, np.abs(c))
+                collide = dist < thresh_t
+                col_mats[t, ped_i, ped_j] = collide
+                col_mats[t, ped_j, ped_i] = collide
+                ax = bx
+                ay = by
+    return col_mats
+
+
 def check_collision_per_sample_no_gt(sample, ped_radius=0.1):
     """sample: (num_peds, ts, 2)"""
 
     sample = sample.transpose(1, 0, 2)  # (ts, n_ped, 2)
+    if NUMBA_AVAILABLE:
+        collision_mat_pred_t_bool = _collision_mats_kernel(np.ascontiguousarray(sample), float(ped_radius * 2),
+                                                           sample.dtype.type(ped_radius * 2))
+        n_ped_with_col_pred_per_sample = np.any(collision_mat_pred_t_bool, axis=(0, 1))
+        return n_ped_with_col_pred_per_sample, collision_mat_pred_t_bool
+
     ts, num_peds, _ = sample.shape
     num_ped_pairs = (num_peds * (num_peds - 1)) // 2
 
@@ -735,6 +735,6 @@ class AgentFormer(nn.Module):
             params = [self.data, self.loss_cfg[loss_name]]
             loss, loss_unweighted = loss_func[loss_name](*params)
             total_loss += loss.squeeze()
-            loss_dict[loss_name] = loss.item()
-            loss_unweighted_dict[loss_name] = loss_unweighted.item()
+            loss_dict[loss_name] = loss.detach()
+            loss_unweighted_dict[loss_name] = loss_unweighted.detach()
         return total_loss, loss_dict, loss_unweighted_dict
@@ -169,8 +169,8 @@ class DLow(nn.Module):
         for loss_name in self.loss_names:
             loss, loss_unweighted = loss_func[loss_name](self.data, self.loss_cfg[loss_name])
             total_loss += loss
-            loss_dict[loss_name] = loss.item()
-            loss_unweighted_dict[loss_name] = loss_unweighted.item()
+            loss_dict[loss_name] = loss.detach()
+            loss_unweighted_dict[loss_name] = loss_unweighted.detach()
         return total_loss, loss_dict, loss_unweighted_dict
 
     def step_annealer(self):
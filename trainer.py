@@ -2,16 +2,17 @@ import os
 from itertools import starmap
 from functools import partial
 import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import numpy as np
 import torch
 import pytorch_lightning as pl
 
 from model.model_lib import model_dict
 from eval import eval_one_seq
-from metrics import stats_func
+from metrics import stats_func, warmup_kernels
 from utils.utils import mkdir_if_missing
 from utils.torch import get_scheduler
-from visualization_utils import plot_anim_grid, get_metrics_str
+from visualization_utils import plot_anim_grid, plot_anim_grid_star, get_metrics_str
 
 
 def save_trajectories(trajectory, save_dir, seq_name, frame, suffix=''):
@@ -30,51 +31,97 @@ def save_trajectories(trajectory, save_dir, seq_name, frame, suffix=''):
 
     if isinstance(trajectory, torch.Tensor):
         trajectory = trajectory.cpu().numpy()
-    np.savetxt(fname, trajectory, fmt="%.3f")
+    if trajectory.ndim == 1:  # same layout as np.savetxt: one value per row
+        trajectory = trajectory[:, np.newaxis]
+    # format the whole array with one %-operation and write a single buffer instead of np.savetxt's per-row writes
+    num_rows, num_cols = trajectory.shape
+    text = (" ".join(["%.3f"] * num_cols) + "\n") * num_rows % tuple(trajectory.ravel().tolist())
+    with open(fname, 'wb', buffering=1 << 20) as f:
+        f.write(text.encode())
+
+
+def save_trajectories_bin(trajectory, save_dir, seq_name, frame, suffix=''):
+    """Save trajectories as raw float32 values, much faster to write and read back than text.
+    The array can be loaded with np.fromfile(fname, dtype=np.float32).reshape(-1, n_cols).
+    Input:
+        same as save_trajectories.
+    """
+    fname = f"{save_dir}/{seq_name}/frame_{int(frame):06d}{suffix}.bin"
+    mkdir_if_missing(fname)
+
+    if isinstance(trajectory, torch.Tensor):
+        trajectory = trajectory.cpu().numpy()
+    with open(fname, 'wb', buffering=1 << 20) as f:
+        np.ascontiguousarray(trajectory, dtype=np.float32).tofile(f)
 
 
-def format_agentformer_trajectories(trajectory, data, cfg, timesteps=12, frame_scale=10, future=True):
-    formatted_trajectories = []
+def get_trajectory_columns(dataset):
+    """Columns used to format the trajectories of a dataset.
+    Return:
+        xy_cols: (list) columns of the raw data holding the 2D position.
+        final_cols: (list/None) columns to keep in the output, None keeps all of them.
+        scale_frame: (bool) whether the frame_id is multiplied by the frame scale.
+        xy_cols is None for datasets that do not support trajectory formatting.
+    """
+    if dataset in ['eth', 'hotel', 'univ', 'zara1', 'zara2']:
+        # [13, 15] correspoinds to the 2D position
+        return [13, 15], [0, 1, 13, 15], True
+    elif dataset in ['gen', 'real_gen', 'adversarial']:
+        return [13, 15], None, False
+    elif 'sdd' in dataset:
+        return [2, 3], None, dataset == 'trajnet_sdd'
+    return None, None, False
+
+
+def format_agentformer_trajectories(trajectory, data, xy_cols, final_cols=None, scale_frame=False,
+                                    timesteps=12, frame_scale=10, future=True):
+    if xy_cols is None:
+        raise NotImplementedError()
+    # move to host once instead of once per (agent, timestep) cell. The copy is kept blocking
+    # since the values are read right away.
+    if isinstance(trajectory, torch.Tensor):
+        trajectory = trajectory.detach().contiguous().cpu().numpy()
     if not future:
-        trajectory = torch.flip(trajectory, [0, 1])
+        trajectory = trajectory[::-1, ::-1]  # negative-stride view, no copy
+    frames = data['fut_data'] if future else data['pre_data']
+    frames = frames[:timesteps]
+    # per-timestep track_id -> row lookup built by the preprocessor
+    row_of = data['fut_row_of'] if future else data['pre_row_of']
+    num_valid = int((data['pred_mask'] == 1.0).sum()) if data['pred_mask'] is not None else len(data['valid_id'])
+    if num_valid == 0:
+        return np.array([])
+
+    # write every agent block straight into one (num_valid * timesteps, C) buffer
+    formatted_trajectories = np.empty((num_valid * len(frames), frames[0].shape[1]), dtype=frames[0].dtype)
+    offset = 0
     for i, track_id in enumerate(data['valid_id']):
         if data['pred_mask'] is not None and data['pred_mask'][i] != 1.0:
             continue
-        for j in range(timesteps):
-            if future:
-                curr_data = data['fut_data'][j]
-            else:
-                curr_data = data['pre_data'][j]
-            # Get data with the same track_id
-            updated_data = curr_data[curr_data[:, 1] == track_id].squeeze()
-            if cfg.dataset in [
-                    'eth', 'hotel', 'univ', 'zara1', 'zara2', 'gen',
-                    'real_gen', 'adversarial'
-            ]:
-                # [13, 15] correspoinds to the 2D position
-                updated_data[[13, 15]] = trajectory[i, j].cpu().numpy()
-            elif 'sdd' in cfg.dataset:
-                updated_data[[2, 3]] = trajectory[i, j].cpu().numpy()
-            else:
-                raise NotImplementedError()
-            formatted_trajectories.append(updated_data)
-    if len(formatted_trajectories) == 0:
-        return np.array([])
-
-    # Convert to numpy array and get [frame_id, track_id, x, y]
-    formatted_trajectories = np.vstack(formatted_trajectories)
-    if cfg.dataset in [ 'eth', 'hotel', 'univ', 'zara1', 'zara2' ]:
-        formatted_trajectories = formatted_trajectories[:, [0, 1, 13, 15]]
-        formatted_trajectories[:, 0] *= frame_scale
-    elif cfg.dataset == 'trajnet_sdd':
-        formatted_trajectories[:, 0] *= frame_scale
+        # Get data with the same track_id
+        for j, curr_data in enumerate(frames):
+            formatted_trajectories[offset + j] = curr_data[row_of[j][track_id]]
+        formatted_trajectories[offset:offset + len(frames), xy_cols] = trajectory[i, :timesteps]
+        offset += len(frames)
 
+    # reverse the rows as a view of the buffer, the column selection below is then the only copy
     if not future:
-        formatted_trajectories = np.flip(formatted_trajectories, axis=0)
+        formatted_trajectories = formatted_trajectories[::-1]
+
+    # get [frame_id, track_id, x, y]
+    if final_cols is not None:
+        formatted_trajectories = formatted_trajectories[:, final_cols]
+    if scale_frame:
+        formatted_trajectories[:, 0] *= frame_scale
 
     return formatted_trajectories
 
 
+def _make_formatter(cfg):
+    """format_agentformer_trajectories with the column layout of cfg.dataset bound once."""
+    xy_cols, final_cols, scale_frame = get_trajectory_columns(cfg.dataset)
+    return partial(format_agentformer_trajectories, xy_cols=xy_cols, final_cols=final_cols, scale_frame=scale_frame)
+
+
 class AgentFormerTrainer(pl.LightningModule):
     def __init__(self, cfg, args):
         super().__init__()
@@ -82,15 +129,23 @@ class AgentFormerTrainer(pl.LightningModule):
         self.model = model_dict[model_id](cfg)
         self.cfg = cfg
         self.args = args
-        num_workers = int(multiprocessing.cpu_count() / (args.devices + 1e-5)) if args.devices is not None else float('inf')
+        # cpus this process may run on (cgroup / taskset aware), shared between the devices
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+        num_workers = max(1, cpus // max(1, args.devices or 1))
         self.num_workers = min(args.num_workers, num_workers)
+        print(f"using {self.num_workers} workers for metrics and visualization")
         self.batch_size = args.batch_size
         self.collision_rad = cfg.get('collision_rad', 0.1)
         self.hparams.update(vars(cfg))
         self.hparams.update(vars(args))
         self.model_name = "_".join(self.cfg.id.split("_")[1:])
         self.dataset_name = self.cfg.id.split("_")[0].replace('-', '_')
+        self._format_fn = _make_formatter(cfg)
         self.validation_step_outputs = []
+        self._viz_pool = None
+        self._metric_pool = None
+        self._io_pool = None
+        self._io_futures = []
 
     def update_args(self, args):
         self.args = args
@@ -98,6 +153,15 @@ class AgentFormerTrainer(pl.LightningModule):
     def on_test_start(self):
         self.model.set_device(self.device)
 
+    def on_test_end(self):
+        # flush the pending trajectory writes and surface any error they raised
+        if self._io_pool is not None:
+            self._io_pool.shutdown(wait=True)
+            self._io_pool = None
+        for future in self._io_futures:
+            future.result()
+        self._io_futures = []
+
     def on_fit_start(self):
         self.model.set_device(self.device)
 
@@ -107,15 +171,29 @@ class AgentFormerTrainer(pl.LightningModule):
         total_loss, loss_dict, loss_unweighted_dict = self.model.compute_loss()
 
         # losses
-        self.log(f'{mode}/loss', total_loss.item(), on_epoch=True, sync_dist=True, logger=True, batch_size=self.batch_size)
+        # only reduce across devices at epoch end, a synced on_step log costs one all-reduce per batch
+        self.log(f'{mode}/loss', total_loss.detach(), on_step=False, on_epoch=True, sync_dist=True, logger=True, batch_size=self.batch_size)
         for loss_name, loss in loss_dict.items():
             self.log(f'{mode}/{loss_name}', loss, on_step=False, on_epoch=True, sync_dist=True, logger=True, batch_size=self.batch_size)
 
-        gt_motion = self.cfg.traj_scale * data['fut_motion'].transpose(1, 0).cpu()
-        pred_motion = self.cfg.traj_scale * data[f'infer_dec_motion'].detach().cpu()
-        obs_motion = self.cfg.traj_scale * data[f'pre_motion'].cpu()  # .transpose(1, 0).cpu()
-        return {'loss': total_loss, **loss_dict, 'frame': batch['frame'], 'seq': batch['seq'],
-                'gt_motion': gt_motion, 'pred_motion': pred_motion, 'obs_motion': obs_motion, 'data': data}
+        step_output = {'loss': total_loss, **loss_dict, 'frame': batch['frame'], 'seq': batch['seq'], 'data': data}
+        if mode == 'train':  # motions are only needed for val / test metrics
+            return step_output
+
+        # queue the three copies back to back and wait for them once. Each copy is a fresh contiguous
+        # float32 host tensor, so it can be scaled in place without touching the model's data.
+        host_copy = partial(torch.Tensor.to, device='cpu', dtype=torch.float32, non_blocking=True, copy=True,
+                            memory_format=torch.contiguous_format)
+        gt_motion = host_copy(data['fut_motion'].transpose(1, 0).detach())
+        pred_motion = host_copy(data[f'infer_dec_motion'].detach())
+        obs_motion = host_copy(data[f'pre_motion'].detach())  # .transpose(1, 0).cpu()
+        if self.device.type == 'cuda':
+            torch.cuda.current_stream(self.device).synchronize()
+        # store numpy arrays once here rather than converting them again at epoch end
+        for key, motion in [('gt_motion_np', gt_motion), ('pred_motion_np', pred_motion), ('obs_motion_np', obs_motion)]:
+            step_output[key] = motion.numpy()
+            step_output[key] *= self.cfg.traj_scale
+        return step_output
 
     def training_step(self, batch, batch_idx):
         if self.args.tqdm_rate == 0 and batch_idx % 5 == 0:
@@ -129,9 +207,9 @@ class AgentFormerTrainer(pl.LightningModule):
 
     def test_step(self, batch, batch_idx):
         return_dict = self._step(batch, 'test')
-        pred_motion = return_dict['pred_motion']
-        gt_motion = return_dict['gt_motion']
-        obs_motion = return_dict['obs_motion']
+        pred_motion = return_dict['pred_motion_np']
+        gt_motion = return_dict['gt_motion_np']
+        obs_motion = return_dict['obs_motion_np']
 
         if self.args.save_traj:
             if self.dataset_name == 'trajnet_sdd':
@@ -139,28 +217,34 @@ class AgentFormerTrainer(pl.LightningModule):
             else:
                 save_dir = f'../trajectory_reward/results/trajectories/{self.model_name}'
             frame = batch['frame'] * batch['frame_scale']
-            for idx, sample in enumerate(pred_motion.transpose(0, 1)):
-                formatted = format_agentformer_trajectories(sample, batch, self.cfg, timesteps=12,
-                                                            frame_scale=batch['frame_scale'], future=True)
-                save_trajectories(formatted, save_dir, batch['seq'], frame, suffix=f"/sample_{idx:03d}")
-            formatted = format_agentformer_trajectories(gt_motion, batch, self.cfg, timesteps=12,
-                                                        frame_scale=batch['frame_scale'], future=True)
-            save_trajectories(formatted, save_dir, batch['seq'], frame, suffix='/gt')
-            formatted = format_agentformer_trajectories(obs_motion.transpose(0, 1), batch, self.cfg, timesteps=8,
-                                                        frame_scale=batch['frame_scale'], future=False)
-            save_trajectories(formatted, save_dir, batch['seq'], frame, suffix="/obs")
+            # write files from a background thread so disk I/O overlaps with the next batches
+            if self._io_pool is None:
+                self._io_pool = ThreadPoolExecutor(max_workers=4)
+            save = partial(self._io_pool.submit, save_trajectories_bin if self.args.save_traj_bin else save_trajectories)
+            for idx, sample in enumerate(pred_motion.swapaxes(0, 1)):
+                formatted = self._format_fn(sample, batch, timesteps=12, frame_scale=batch['frame_scale'], future=True)
+                self._io_futures.append(save(formatted, save_dir, batch['seq'], frame, suffix=f"/sample_{idx:03d}"))
+            formatted = self._format_fn(gt_motion, batch, timesteps=12, frame_scale=batch['frame_scale'], future=True)
+            self._io_futures.append(save(formatted, save_dir, batch['seq'], frame, suffix='/gt'))
+            formatted = self._format_fn(obs_motion.swapaxes(0, 1), batch, timesteps=8,
+                                        frame_scale=batch['frame_scale'], future=False)
+            self._io_futures.append(save(formatted, save_dir, batch['seq'], frame, suffix="/obs"))
 
         return return_dict
 
     def _epoch_end(self, outputs, mode='test'):
-        args_list = [(output['pred_motion'].numpy(), output['gt_motion'].numpy()) for output in outputs]
+        args_list = [(output['pred_motion_np'], output['gt_motion_np']) for output in outputs]
 
         # calculate metrics for each sequence
         if self.args.mp:
-            with multiprocessing.Pool(self.num_workers) as pool:
-                all_metrics = pool.starmap(partial(eval_one_seq,
-                                                   collision_rad=self.collision_rad,
-                                                   return_sample_vals=self.args.save_viz), args_list)
+            # keep the workers alive across epochs instead of forking a new pool every time,
+            # each worker compiles the metric kernels once when it starts
+            if self._metric_pool is None:
+                self._metric_pool = multiprocessing.get_context('fork').Pool(self.num_workers,
+                                                                             initializer=warmup_kernels)
+            all_metrics = self._metric_pool.starmap(partial(eval_one_seq,
+                                                            collision_rad=self.collision_rad,
+                                                            return_sample_vals=self.args.save_viz), args_list)
         else:
             all_metrics = starmap(partial(eval_one_seq,
                                           collision_rad=self.collision_rad,
@@ -168,7 +252,7 @@ class AgentFormerTrainer(pl.LightningModule):
         all_metrics, all_sample_vals, argmins, collision_mats = zip(*all_metrics)
 
         # aggregate metrics across sequences
-        num_agent_per_seq = np.array([output['gt_motion'].shape[0] for output in outputs])
+        num_agent_per_seq = np.array([output['gt_motion_np'].shape[0] for output in outputs])
         total_num_agents = np.sum(num_agent_per_seq)
         results_dict = {}
         for key, values in zip(stats_func.keys(), zip(*all_metrics)):
@@ -181,7 +265,14 @@ class AgentFormerTrainer(pl.LightningModule):
         # get stats related to collision_rejection sampling
         is_test_mode = mode == 'test'
 
-        # print results to console for easy copy-and-paste
+        # average metrics across devices with a single reduce instead of one per logged key. Going through
+        # the trainer's strategy makes this a no-op for single-device runs such as the test after DDP fit.
+        if self.trainer.world_size > 1:
+            metrics_t = torch.tensor(list(results_dict.values()), dtype=torch.float32, device=self.device)
+            metrics_t = self.trainer.strategy.reduce(metrics_t, reduce_op="mean")
+            results_dict = dict(zip(results_dict.keys(), metrics_t.tolist()))
+
+        # print results to console for easy copy-and-paste (the agent count is this device's only)
         if is_test_mode:
             print(f"\n\n\n{self.current_epoch}")
             for key, value in results_dict.items():
@@ -190,17 +281,17 @@ class AgentFormerTrainer(pl.LightningModule):
 
         # log metrics to tensorboard
         for key, value in results_dict.items():
-            self.log(f'{mode}/{key}', value, sync_dist=True, prog_bar=True, logger=True)
+            self.log(f'{mode}/{key}', value, sync_dist=False, prog_bar=True, logger=True)
 
     def _save_viz(self, outputs, all_sample_vals, all_meters_values, argmins, collision_mats, tag=''):
         seq_to_plot_args = []
         for frame_i, (output, seq_to_sample_metrics) in enumerate(zip(outputs, all_sample_vals)):
             frame = output['frame']
             seq = output['seq']
-            obs_traj = output['obs_motion'].numpy()
+            obs_traj = output['obs_motion_np']
             assert obs_traj.shape[0] == 8
-            pred_gt_traj = output['gt_motion'].numpy().swapaxes(0, 1)
-            pred_fake_traj = output['pred_motion'].numpy().transpose(1, 2, 0, 3)  # (samples, ts, n_peds, 2)
+            pred_gt_traj = output['gt_motion_np'].swapaxes(0, 1)
+            pred_fake_traj = output['pred_motion_np'].transpose(1, 2, 0, 3)  # (samples, ts, n_peds, 2)
 
             num_samples, _, n_ped, _ = pred_fake_traj.shape
 
@@ -238,8 +329,11 @@ class AgentFormerTrainer(pl.LightningModule):
             seq_to_plot_args.append(plot_args_list)
 
         if self.args.mp:
-            with multiprocessing.Pool(self.num_workers) as pool:
-                pool.starmap(plot_anim_grid, seq_to_plot_args)
+            # reuse one pool across epochs, and batch the tasks sent to each worker
+            if self._viz_pool is None:
+                self._viz_pool = ProcessPoolExecutor(max_workers=self.num_workers)
+            chunksize = max(1, len(seq_to_plot_args) // (4 * self.num_workers))
+            list(self._viz_pool.map(plot_anim_grid_star, seq_to_plot_args, chunksize=chunksize))
         else:
             list(starmap(plot_anim_grid, seq_to_plot_args))
 
@@ -257,6 +351,15 @@ class AgentFormerTrainer(pl.LightningModule):
     def test_epoch_end(self, outputs):
         self._epoch_end(outputs)
 
+    def teardown(self, stage=None):
+        if self._metric_pool is not None:
+            self._metric_pool.close()
+            self._metric_pool.join()
+            self._metric_pool = None
+        if self._viz_pool is not None:
+            self._viz_pool.shutdown()
+            self._viz_pool = None
+
     def on_load_checkpoint(self, checkpoint):
         if 'model_dict' in checkpoint and 'epoch' in checkpoint:
             checkpoint['state_dict'] = {f'model.{k}': v for k, v in checkpoint['model_dict'].items()}
@@ -70,6 +70,11 @@ def plot_anim_grid(save_fn, title=None, plot_size=None, *list_of_arg_dicts):
     plt.close(fig)
 
 
+def plot_anim_grid_star(args):
+    """plot_anim_grid with its arguments packed in one tuple, for Executor.map"""
+    return plot_anim_grid(*args)
+
+
 def plot_traj_anim(**kwargs):
     AnimObj().plot_traj_anim(**kwargs)
 